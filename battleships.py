@@ -1,8 +1,11 @@
+import startup
+
 import endpoints
 from protorpc import message_types
 from protorpc import messages
 from protorpc import remote
 
+import ratelimit
 import utils
 from models import Game
 from models import GameHistoryForm
@@ -13,7 +16,13 @@ from models import Position
 from models import RankingForm
 from models import RegisterUserForm
 from models import ShipPlacementForm
+from models import StatShard
+from models import StatsForm
 from models import StringMessage
+from models import ThrottleCount
+from models import Tournament
+from models import TournamentForm
+from models import TournamentInfoForm
 from models import User
 
 WEB_CLIENT_ID = (
@@ -31,16 +40,33 @@ LIST_GAMES_REQUEST = endpoints.ResourceContainer(
     state=messages.EnumField(
         Game.GameState, 1,
         default=Game.GameState.WAITING_FOR_OPPONENT),
-    limit=messages.IntegerField(2, default=10))
+    limit=messages.IntegerField(2, default=10),
+    field_mask=messages.StringField(3))
+USER_GAMES_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    field_mask=messages.StringField(1))
 GAME_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     game_key=messages.StringField(1, required=True))
+GAME_INFO_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    game_key=messages.StringField(1, required=True),
+    field_mask=messages.StringField(2))
 POSITION_REQUEST = endpoints.ResourceContainer(
     Position,
     game_key=messages.StringField(1, required=True))
 SHIP_PLACEMENT_REQUEST = endpoints.ResourceContainer(
     ShipPlacementForm,
     game_key=messages.StringField(1, required=True))
+TOURNAMENT_NEW_REQUEST = endpoints.ResourceContainer(TournamentForm)
+TOURNAMENT_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    tournament_key=messages.StringField(1, required=True))
+TOURNAMENT_GAMES_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    tournament_key=messages.StringField(1, required=True),
+    offset=messages.IntegerField(2, default=0),
+    limit=messages.IntegerField(3, default=100))
 
 
 @endpoints.api(
@@ -81,14 +107,17 @@ class BattleshipApi(remote.Service):
                       path='game/list',
                       name='get_games_list',
                       http_method='GET')
+    @ratelimit.limit(capacity=10, per_second=1)
     def get_games_list(self, request):
         """ Returns a list of games of an optionally supplied state """
         auth_user = utils.get_auth_user()
         user = User.by_email(auth_user.email())
+        fields = Game.parse_field_mask(request.field_mask)
         games = Game.by_game_state(
             request.state,
-            request.limit)
-        return GameListForm(games=[game.to_form() for game in games])
+            request.limit,
+            keys_only=fields == Game.KEY_FIELDS)
+        return GameListForm(games=Game.to_forms(games, fields))
 
     @endpoints.method(request_message=GAME_REQUEST,
                       response_message=GameInfoForm,
@@ -103,7 +132,7 @@ class BattleshipApi(remote.Service):
         game.add_player(user)
         return game.to_form()
 
-    @endpoints.method(request_message=VOID_REQUEST,
+    @endpoints.method(request_message=USER_GAMES_REQUEST,
                       response_message=GameListForm,
                       path='game/active',
                       name='get_user_games',
@@ -112,8 +141,9 @@ class BattleshipApi(remote.Service):
         """ Gets a list of the user's games that are active """
         auth_user = utils.get_auth_user()
         user = User.by_email(auth_user.email())
+        fields = Game.parse_field_mask(request.field_mask)
         games = Game.get_active_games(user)
-        return GameListForm(games=[game.to_form() for game in games])
+        return GameListForm(games=Game.to_forms(games, fields))
 
     @endpoints.method(request_message=GAME_REQUEST,
                       response_message=GameInfoForm,
@@ -150,6 +180,7 @@ class BattleshipApi(remote.Service):
                       path='game/{game_key}/guess',
                       name='game_guess',
                       http_method='POST')
+    @ratelimit.limit(capacity=10, per_second=2)
     def game_guess(self, request):
         """ Have a user submit their guess """
         auth_user = utils.get_auth_user()
@@ -170,6 +201,21 @@ class BattleshipApi(remote.Service):
         user = User.by_email(auth_user.email())
         return RankingForm(rankings=User.get_user_rankings())
 
+    @endpoints.method(request_message=VOID_REQUEST,
+                      response_message=StatsForm,
+                      path='stats',
+                      name='get_stats',
+                      http_method='GET')
+    def get_stats(self, request):
+        """ Get global statistics of all games """
+        auth_user = utils.get_auth_user()
+        user = User.by_email(auth_user.email())
+        form = StatShard.get_stats()
+        form.throttled = [
+            ThrottleCount(method=method, count=count)
+            for method, count in ratelimit.get_throttled_counts().iteritems()]
+        return form
+
     @endpoints.method(request_message=GAME_REQUEST,
                       response_message=GameHistoryForm,
                       path='game/{game_key}/history',
@@ -182,16 +228,64 @@ class BattleshipApi(remote.Service):
         game = Game.by_urlsafe(request.game_key)
         return GameHistoryForm(guesses=game.get_history())
 
-    @endpoints.method(request_message=GAME_REQUEST,
+    @endpoints.method(request_message=GAME_INFO_REQUEST,
                       response_message=GameInfoForm,
                       path='game/{game_key}',
                       name='get_game',
                       http_method='GET')
+    @ratelimit.limit(capacity=20, per_second=2)
     def get_game(self, request):
         """ Get info of a specific game """
         auth_user = utils.get_auth_user()
         user = User.by_email(auth_user.email())
+        fields = Game.parse_field_mask(request.field_mask)
         game = Game.by_urlsafe(request.game_key)
-        return game.to_form()
+        return game.to_form(fields)
+
+    @endpoints.method(request_message=TOURNAMENT_NEW_REQUEST,
+                      response_message=TournamentInfoForm,
+                      path='tournament',
+                      name='tournament_new',
+                      http_method='POST')
+    def tournament_new(self, request):
+        """ Creates a tournament of paired games. Admin only. """
+        utils.get_admin_user()
+        tournament = Tournament.create_tournament(request)
+        return tournament.to_form()
+
+    @endpoints.method(request_message=TOURNAMENT_REQUEST,
+                      response_message=TournamentInfoForm,
+                      path='tournament/{tournament_key}',
+                      name='get_tournament',
+                      http_method='GET')
+    def get_tournament(self, request):
+        """ Get the progress of a tournament. Admin only. """
+        utils.get_admin_user()
+        tournament = Tournament.by_urlsafe(request.tournament_key)
+        return tournament.to_form()
+
+    @endpoints.method(request_message=TOURNAMENT_GAMES_REQUEST,
+                      response_message=GameListForm,
+                      path='tournament/{tournament_key}/games',
+                      name='get_tournament_games',
+                      http_method='GET')
+    def get_tournament_games(self, request):
+        """ Get a page of a tournament's games. Admin only. """
+        utils.get_admin_user()
+        tournament = Tournament.by_urlsafe(request.tournament_key)
+        games = tournament.get_games(request.offset, request.limit)
+        return GameListForm(games=Game.to_forms(games))
+
+    @endpoints.method(request_message=TOURNAMENT_REQUEST,
+                      response_message=TournamentInfoForm,
+                      path='tournament/{tournament_key}/cancel',
+                      name='tournament_cancel',
+                      http_method='DELETE')
+    def tournament_cancel(self, request):
+        """ Cancels every unfinished game of a tournament. Admin only. """
+        utils.get_admin_user()
+        tournament = Tournament.by_urlsafe(request.tournament_key)
+        return tournament.cancel_games().to_form()
 
-api = endpoints.api_server([BattleshipApi])  # register API
+api = startup.measure_first_request(
+    'battleships.api', endpoints.api_server([BattleshipApi]))  # register API
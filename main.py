@@ -1,13 +1,25 @@
 #!/usr/bin/env python
 
+import startup
+
 import datetime
+import itertools
+import json
+import logging
 import webapp2
 
-from google.appengine.api import app_identity
-from google.appengine.api import mail
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 
+import migrations
 from models import User
 from models import Game
+from models import GameArchive
+from models import MigrationStatus
+from models import StatShard
 
 
 class SendReminderEmail(webapp2.RequestHandler):
@@ -15,6 +27,10 @@ class SendReminderEmail(webapp2.RequestHandler):
         """Send a reminder email to each User with an email about games.
         Called every hour using a cron job. If the game is older than
         two hours, cancel the game. """
+        # Only the cron uses these, so they are not imported on startup.
+        from google.appengine.api import app_identity
+        from google.appengine.api import mail
+
         app_id = app_identity.get_application_id()
         inactive_games = Game.get_inactive_games()
 
@@ -56,6 +72,193 @@ class SendReminderEmail(webapp2.RequestHandler):
                     body.format(p2.name))
 
 
-app = webapp2.WSGIApplication([
-    ('/crons/send_reminder', SendReminderEmail)
-    ], debug=True)
+class ArchiveGames(webapp2.RequestHandler):
+    def get(self):
+        """Move completed and cancelled games into the archive.
+        Called every day using a cron job."""
+        archived = GameArchive.archive_games()
+        self.response.write('Archived {} games.'.format(archived))
+
+
+class ExportGames(webapp2.RequestHandler):
+    def get(self):
+        """Export games as newline delimited JSON, one game per line.
+
+        Query parameters:
+            state: Only export games in this GameState.
+            since, until: Only export games last updated in this range.
+                Dates in the form YYYY-MM-DD.
+            archived: Set to 1 to export archived games instead.
+            limit: The maximum number of games to export. Defaults to 1000.
+            cursor: Resume an export from a previous X-Export-Cursor.
+
+        The X-Export-Cursor header is set when more games remain."""
+        try:
+            state = self.request.get('state')
+            state = state and Game.GameState.lookup_by_name(state) or None
+            since = self._get_date('since')
+            until = self._get_date('until')
+            cursor = self.request.get('cursor')
+            cursor = cursor and Cursor(urlsafe=cursor) or None
+            limit = int(self.request.get('limit', 1000))
+        except (KeyError, ValueError, datastore_errors.BadValueError):
+            self.abort(400)
+        if limit < 1:
+            self.abort(400)
+        archived = self.request.get('archived') == '1'
+        if archived and (state or since or until):
+            self.abort(400, 'Archived games cannot be filtered.')
+
+        pages = Game.export_pages(state, since, until, cursor, archived,
+                                  limit=limit)
+        try:
+            # A cursor from a different query fails on the first page.
+            first_page = next(pages)
+        except datastore_errors.BadRequestError:
+            self.abort(400, 'Invalid cursor.')
+
+        self.response.content_type = 'application/x-ndjson'
+        for records, cursor, more in itertools.chain([first_page], pages):
+            for record in records:
+                self.response.write(json.dumps(record))
+                self.response.write('\n')
+        if more and cursor:
+            self.response.headers['X-Export-Cursor'] = cursor.urlsafe()
+
+    def _get_date(self, name):
+        value = self.request.get(name)
+        return value and datetime.datetime.strptime(value, '%Y-%m-%d') or None
+
+
+class ImportGames(webapp2.RequestHandler):
+    # Number of games saved by a single put_multi call.
+    BATCH_SIZE = 100
+
+    def post(self):
+        """Import games from newline delimited JSON made by ExportGames.
+        Games are saved in batches with put_multi. Games that already exist
+        in the other of the Game and GameArchive kinds are skipped."""
+        imported = 0
+        skipped = 0
+        batch = []
+        for line in self.request.body_file:
+            if not line.strip():
+                continue
+            batch.append(json.loads(line))
+            if len(batch) == self.BATCH_SIZE:
+                saved, duplicates = Game.import_records(batch)
+                imported += saved
+                skipped += duplicates
+                batch = []
+        if batch:
+            saved, duplicates = Game.import_records(batch)
+            imported += saved
+            skipped += duplicates
+        self.response.write('Imported {} games. Skipped {} games.'.format(
+            imported, skipped))
+
+
+class RepairRecords(webapp2.RequestHandler):
+    # Memcache key holding the result of the last repair.
+    RESULT_KEY = 'repair_records:result'
+    # Most corrections and deferred users kept in the stored result.
+    MAX_LISTED = 100
+
+    def get(self):
+        """Report the result of the last repair of every User's win and
+        played counts. Set start=1 to queue a new repair, and dry_run=1
+        to only report the corrections without saving them. The repair
+        runs on the task queue, which allows longer requests."""
+        if self.request.get('start') == '1':
+            taskqueue.add(
+                url='/tasks/repair_records',
+                queue_name='maintenance',
+                params={'dry_run': self.request.get('dry_run')})
+            result = {'queued': True}
+        else:
+            result = memcache.get(self.RESULT_KEY)
+            if result is None:
+                self.abort(404, 'No repair result available.')
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(result))
+
+
+class RepairRecordsTask(webapp2.RequestHandler):
+    def post(self):
+        """Rebuild every User's win and played counts from completed games.
+        Called from the task queue. Only the first MAX_LISTED corrections
+        and deferred users are kept in the stored result, so it stays
+        within memcache's value size limit."""
+        dry_run = self.request.get('dry_run') == '1'
+        result = User.repair_records(dry_run=dry_run)
+        logging.info('Repaired user records: %s', result)
+        limit = RepairRecords.MAX_LISTED
+        summary = {
+            'dry_run': dry_run,
+            'games_scanned': result['games_scanned'],
+            'users_scanned': result['users_scanned'],
+            'corrections_total': len(result['corrections']),
+            'corrections': result['corrections'][:limit],
+            'deferred_total': len(result['deferred']),
+            'deferred': result['deferred'][:limit]
+        }
+        memcache.set(RepairRecords.RESULT_KEY, summary)
+
+
+class SeedStats(webapp2.RequestHandler):
+    def get(self):
+        """Queue a recount of the global statistics counters from the games
+        in the datastore. Run once after the counters are deployed."""
+        taskqueue.add(url='/tasks/seed_stats', queue_name='maintenance')
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps({'queued': True}))
+
+
+class SeedStatsTask(webapp2.RequestHandler):
+    def post(self):
+        """Recount the global statistics counters. Called from the task
+        queue."""
+        totals = StatShard.seed()
+        logging.info('Seeded stats: %s', totals)
+
+
+class StartMigration(webapp2.RequestHandler):
+    def get(self):
+        """Report the status of a schema migration. Set start=1 to start
+        the migration, or to run it again from the beginning."""
+        name = self.request.get('name')
+        try:
+            migrations.get_migration(name)
+        except KeyError:
+            self.abort(404, 'Unknown migration.')
+        if self.request.get('start') == '1':
+            status = migrations.start(name)
+        else:
+            status = MigrationStatus.get_by_id(name)
+            if not status:
+                self.abort(404, 'Migration has not been started.')
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(status.to_dict()))
+
+
+class MigrateBatch(webapp2.RequestHandler):
+    def post(self):
+        """Migrate one batch of entities. Called from the task queue."""
+        migrations.run_batch(
+            self.request.get('name'),
+            int(self.request.get('run')),
+            self.request.get('cursor') or None)
+
+
+app = startup.measure_first_request('main.app', webapp2.WSGIApplication([
+    ('/crons/send_reminder', SendReminderEmail),
+    ('/crons/archive_games', ArchiveGames),
+    ('/admin/export', ExportGames),
+    ('/admin/import', ImportGames),
+    ('/admin/repair_records', RepairRecords),
+    ('/admin/migrate', StartMigration),
+    ('/tasks/migrate', MigrateBatch),
+    ('/tasks/repair_records', RepairRecordsTask),
+    ('/admin/seed_stats', SeedStats),
+    ('/tasks/seed_stats', SeedStatsTask)
+    ], debug=True))
@@ -0,0 +1,193 @@
+"""migrations.py - Online batched schema migrations for Datastore entities.
+
+A migration walks every key of a kind with a keys only cursor query, one
+batch per task queue task. Each batch is split into chunks that are read,
+transformed and saved in their own cross-group transactions, so concurrent
+writes from live requests are never overwritten. Entities already at the
+migration's version are skipped, so a migration can be rerun safely.
+
+Models being migrated must have a schema_version property and a
+SCHEMA_VERSION that their _pre_put_hook writes, so entities saved by live
+requests during a migration are written in the new format. Models with
+automatic timestamps must define preserve_timestamps(), which is called
+before a migrated entity is saved so the migration does not change them."""
+
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import utils
+from models import Game
+from models import MigrationStatus
+
+# Keys read by each task.
+BATCH_SIZE = 100
+# Entities per transaction. Cross-group transactions allow 25 groups.
+CHUNK_SIZE = 25
+# Seconds to wait between batches, to leave room for live traffic.
+BATCH_DELAY = 1
+QUEUE_NAME = 'migrations'
+TASK_URL = '/tasks/migrate'
+
+# Migration name to Migration.
+MIGRATIONS = {}
+# Properties a migration put must leave unchanged.
+TIMESTAMP_PROPERTIES = ['last_update']
+
+
+class MigrationError(Exception):
+    """ Raised when a migration would change data it should not """
+
+
+class Migration(object):
+    """ A transform bringing entities of a kind up to a schema version.
+
+    Properties:
+        name: Unique name of the migration.
+        model: The ndb Model class being migrated.
+        version: The schema_version of migrated entities.
+        transform: Function changing an entity in place.
+    """
+    def __init__(self, name, model, version, transform):
+        self.name = name
+        self.model = model
+        self.version = version
+        self.transform = transform
+
+
+def register(name, model, version):
+    """ Decorator registering a transform function as a migration """
+    def decorator(transform):
+        MIGRATIONS[name] = Migration(name, model, version, transform)
+        return transform
+    return decorator
+
+
+def get_migration(name):
+    """ Returns a registered Migration. Raises KeyError if unknown. """
+    return MIGRATIONS[name]
+
+
+def start(name):
+    """ Starts, or restarts, a migration from the first entity.
+
+    Returns:
+        The MigrationStatus of the new run.
+    """
+    get_migration(name)
+    status = (MigrationStatus.get_by_id(name) or
+              MigrationStatus(id=name))
+    status.run += 1
+    status.cursor = None
+    status.processed = 0
+    status.migrated = 0
+    status.done = False
+    status.error = None
+    status.put()
+    memcache.delete(MigrationStatus.CACHE_PREFIX + name)
+    _add_task(status, countdown=0)
+    return status
+
+
+def run_batch(name, run, cursor):
+    """ Migrates one batch of entities and queues the next batch.
+
+    Args:
+        name: Name of the migration.
+        run: The run the task belongs to. Tasks from older runs are ignored.
+        cursor: urlsafe cursor the batch starts at, or None for the first.
+    """
+    migration = get_migration(name)
+    status = MigrationStatus.get_by_id(name)
+    if not status or status.run != run or status.error:
+        # The task belongs to an older or failed run.
+        return
+    if status.cursor != cursor:
+        # The batch has already been migrated. Make sure the next batch
+        # was queued in case the task failed after saving its progress.
+        if not status.done:
+            _add_task(status, countdown=BATCH_DELAY)
+        return
+
+    keys, next_cursor, more = migration.model.query().fetch_page(
+        BATCH_SIZE, keys_only=True,
+        start_cursor=cursor and Cursor(urlsafe=cursor) or None)
+    futures = [_migrate_chunk(migration, chunk)
+               for chunk in utils.chunks(keys, CHUNK_SIZE)]
+    ndb.Future.wait_all(futures)
+    try:
+        migrated = sum(future.get_result() for future in futures)
+    except MigrationError, e:
+        # Retrying would fail the same way, so stop the migration and
+        # report why. Chunks that succeeded are skipped by the next run.
+        logging.error('Migration %s failed: %s', name, e)
+        status.error = str(e)
+        status.put()
+        return
+
+    status.processed += len(keys)
+    status.migrated += migrated
+    status.cursor = next_cursor and next_cursor.urlsafe()
+    status.done = not more or not keys
+    status.put()
+    if status.done:
+        memcache.delete(MigrationStatus.CACHE_PREFIX + name)
+    else:
+        _add_task(status, countdown=BATCH_DELAY)
+
+
+@ndb.transactional_tasklet(xg=True)
+def _migrate_chunk(migration, keys):
+    """ Transaction migrating up to CHUNK_SIZE entities. Returns the number
+    of entities changed. """
+    entities = yield ndb.get_multi_async(keys)
+    changed = [entity for entity in entities
+               if entity and entity.schema_version < migration.version]
+    originals = []
+    for entity in changed:
+        originals.append(dict(
+            (name, getattr(entity, name)) for name in TIMESTAMP_PROPERTIES
+            if name in entity._properties))
+        migration.transform(entity)
+        entity.schema_version = migration.version
+        if hasattr(entity, 'preserve_timestamps'):
+            entity.preserve_timestamps()
+    if changed:
+        yield ndb.put_multi_async(changed)
+    # Raising here rolls the transaction back.
+    for entity, original in zip(changed, originals):
+        for name, value in original.iteritems():
+            if getattr(entity, name) != value:
+                raise MigrationError('Migration {} changed {} of {}'.format(
+                    migration.name, name, entity.key))
+    raise ndb.Return(len(changed))
+
+
+def _add_task(status, countdown):
+    """ Queues the task for a migration's next batch """
+    params = {'name': status.key.id(), 'run': status.run}
+    if status.cursor:
+        params['cursor'] = status.cursor
+    try:
+        taskqueue.add(
+            url=TASK_URL,
+            queue_name=QUEUE_NAME,
+            params=params,
+            countdown=countdown,
+            # Naming the task stops a batch being queued twice.
+            name='{}-{}-{}'.format(status.key.id(), status.run,
+                                   status.processed))
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+
+@register('game_players', Game, 1)
+def add_game_players(game):
+    """ Version 1: Adds the indexed players property to Games, replacing
+    the OR query on player_one and player_two in get_active_games """
+    game.players = [key for key in [game.player_one, game.player_two]
+                    if key]
@@ -3,10 +3,16 @@ entities used by the BattleShips Game. """
 
 import datetime
 import endpoints
+import logging
+import random
 from protorpc import messages
+from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import msgprop
 
+import utils
+
 
 class User(ndb.Model):
     """ Google AppEngine Datastore Entity representing a User.
@@ -26,6 +32,9 @@ class User(ndb.Model):
     win_ratio = ndb.ComputedProperty(
         lambda u: 1. * u.games_played and 1. * u.games_won / u.games_played)
 
+    # Number of entities read by each page of the record repair.
+    BATCH_SIZE = 500
+
     @classmethod
     def create_user(cls, auth_user, user_name):
         """ Register a username to a user's email address"""
@@ -65,6 +74,143 @@ class User(ndb.Model):
                 ))
         return form_rankings
 
+    @classmethod
+    def repair_records(cls, dry_run=False, shards=8):
+        """ Rebuilds every User's games_won and games_played from the
+        completed games, including archived games.
+
+        The Game and GameArchive kinds are split into key ranges that are
+        tallied concurrently, then the totals are compared against the
+        stored counters. Each difference is added to the User in its own
+        transaction, so wins recorded after the User was read are kept.
+
+        Games updated after the repair started are not tallied. Users with
+        such games are left for the next run rather than corrected against
+        counters that already include them. Archives whose Game still
+        exists, left by an interrupted archive run, are only counted once.
+
+        Args:
+            dry_run: If True, report the corrections without saving them.
+            shards: The number of key ranges to scan concurrently per kind.
+
+        Returns:
+            A dict with the number of games and users scanned, the names of
+            the users left for the next run, and a list of the corrections
+            in the form
+            [{user_name}, {old games_won}, {old games_played},
+             {new games_won}, {new games_played}]
+        """
+        started = datetime.datetime.now()
+        futures = []
+        for lo, hi in utils.split_key_ranges(Game, shards):
+            query = Game.query(Game.game_state == Game.GameState.GAME_COMPLETE)
+            futures.append(cls._tally_games(
+                utils.filter_key_range(query, Game, lo, hi), started))
+        for lo, hi in utils.split_key_ranges(GameArchive, shards):
+            futures.append(cls._tally_games(
+                utils.filter_key_range(GameArchive.query(), GameArchive,
+                                       lo, hi), started))
+
+        games_scanned = 0
+        tally = {}
+        for future in futures:
+            scanned, shard_tally = future.get_result()
+            games_scanned += scanned
+            for key, (won, played) in shard_tally.iteritems():
+                total = tally.setdefault(key, [0, 0])
+                total[0] += won
+                total[1] += played
+
+        users_scanned = 0
+        corrections = []
+        deferred = []
+        cursor = None
+        more = True
+        while more:
+            users, cursor, more = cls.query().fetch_page(
+                cls.BATCH_SIZE, start_cursor=cursor)
+            users_scanned += len(users)
+            wrong = [user for user in users
+                     if [user.games_won, user.games_played] !=
+                     tally.get(user.key, [0, 0])]
+            recent = [cls._has_games_since(user.key, started)
+                      for user in wrong]
+            futures = []
+            for user, has_recent in zip(wrong, recent):
+                if has_recent.get_result():
+                    deferred.append(user.name)
+                    continue
+                won, played = tally.get(user.key, (0, 0))
+                corrections.append([user.name,
+                                    user.games_won, user.games_played,
+                                    won, played])
+                if not dry_run:
+                    futures.append(cls._correct_record(
+                        user.key, won - user.games_won,
+                        played - user.games_played))
+            ndb.Future.wait_all(futures)
+            for future in futures:
+                future.check_success()
+        return {
+            'games_scanned': games_scanned,
+            'users_scanned': users_scanned,
+            'deferred': deferred,
+            'corrections': corrections
+        }
+
+    @classmethod
+    @ndb.tasklet
+    def _has_games_since(cls, key, since):
+        """ Tasklet checking whether a User has a game updated since a
+        datetime """
+        games = yield [
+            Game.query(prop == key, Game.last_update >= since)
+            .get_async(keys_only=True)
+            for prop in [Game.player_one, Game.player_two]]
+        raise ndb.Return(any(games))
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def _correct_record(cls, key, won, played):
+        """ Transaction adding a correction to a User's counters """
+        user = yield key.get_async()
+        user.games_won += won
+        user.games_played += played
+        yield user.put_async()
+
+    @classmethod
+    @ndb.tasklet
+    def _tally_games(cls, query, before):
+        """ Tasklet counting wins and plays per User over a query of Games
+        or GameArchives, skipping games updated at or after before.
+        Returns (games scanned, {user key: [won, played]})
+        """
+        scanned = 0
+        tally = {}
+        cursor = None
+        more = True
+        while more:
+            games, cursor, more = yield query.fetch_page_async(
+                cls.BATCH_SIZE, start_cursor=cursor)
+            scanned += len(games)
+            games = [game for game in games
+                     if game.game_state == Game.GameState.GAME_COMPLETE and
+                     game.last_update < before]
+            if games and isinstance(games[0], GameArchive):
+                # Skip archives whose Game was not deleted. The Game is
+                # tallied instead.
+                live = yield ndb.get_multi_async(
+                    [ndb.Key(Game, game.key.id()) for game in games])
+                games = [game for game, game_live in zip(games, live)
+                         if not game_live]
+            for game in games:
+                for player in [game.player_one, game.player_two]:
+                    record = tally.setdefault(player, [0, 0])
+                    record[1] += 1
+                    if player == game.player_winner:
+                        record[0] += 1
+        raise ndb.Return((scanned, tally))
+
 
 class Game(ndb.Model):
     """ Google AppEngine Datastore Entity representing a Battleship match.
@@ -90,6 +236,11 @@ class Game(ndb.Model):
                     coords: string in form 'x,y' of user's guess
                     result: string result of the guess. Typically hit or miss.
         player_winner: ndb Key to the winner of the match.
+        tournament: ndb Key to the Tournament the game belongs to, if any.
+        players: ndb Keys to both players, for finding a user's games with
+            a single query. Set whenever the game is saved.
+        schema_version: The storage format version the game was saved with.
+            Games saved before version 1 have no players property.
         last_update: A datetime of the last time the game was updated.
     """
     class GameState(messages.Enum):
@@ -132,8 +283,20 @@ class Game(ndb.Model):
     game_board = ndb.JsonProperty()
     game_history = ndb.JsonProperty()
     player_winner = ndb.KeyProperty(kind='User')
+    tournament = ndb.KeyProperty(kind='Tournament', indexed=False)
+    players = ndb.KeyProperty(kind='User', repeated=True)
+    schema_version = ndb.IntegerProperty(default=0, indexed=False)
     last_update = ndb.DateTimeProperty(auto_now=True)
 
+    # The storage format version written by this code.
+    SCHEMA_VERSION = 1
+
+    # Names of the GameInfoForm fields, for field masks.
+    INFO_FIELDS = frozenset(
+        ['urlsafe_key', 'player_one', 'player_two', 'game_state', 'rules'])
+    # A field mask that can be served from a keys only query.
+    KEY_FIELDS = frozenset(['urlsafe_key'])
+
     @classmethod
     def create_game(cls, user, form):
         """ Creates a new Game.
@@ -146,7 +309,36 @@ class Game(ndb.Model):
             Returns the newly created Game.
         """
 
-        settings = form.get_assigned_value('rules') or cls.BoardRules()
+        settings = cls.check_rules(form.get_assigned_value('rules'))
+        game = Game(
+                player_one=user.key,
+                game_state=cls.GameState.WAITING_FOR_OPPONENT,
+                game_settings=settings,
+                game_board={},
+                game_history=[]
+            )
+        game.put()
+        StatShard.increment({
+            StatShard.GAMES_CREATED: 1,
+            StatShard.GAMES_IN_PROGRESS: 1
+        })
+        return game
+
+    @classmethod
+    def check_rules(cls, settings):
+        """ Validates a BoardRules message, filling in any defaults.
+
+        Args:
+            settings: BoardRules supplied by the user, or None.
+
+        Returns:
+            The BoardRules to save with a game.
+
+        Raises:
+            BadRequestException:
+                -If the board dimensions or ship counts are out of range.
+        """
+        settings = settings or cls.BoardRules()
 
         # Fix an issue with default values not saving until assigned.
         settings.width = settings.width
@@ -173,49 +365,66 @@ class Game(ndb.Model):
                 settings.ship_5 > 5):
             raise endpoints.BadRequestException(
                 'Ship count must be between 0-5')
-        game = Game(
-                player_one=user.key,
-                game_state=cls.GameState.WAITING_FOR_OPPONENT,
-                game_settings=settings,
-                game_board={},
-                game_history=[]
-            )
-        game.put()
-        return game
+        return settings
+
+    # Set on Games rebuilt from a GameArchive. They are read only.
+    archived = False
+    # last_update to restore on the next put, set by preserve_timestamps.
+    _preserved_last_update = None
 
     @classmethod
     def by_urlsafe(cls, urlsafe):
-        """ Search for a game by its urlsafe key """
-        try:
-            return ndb.Key(urlsafe=urlsafe).get()
-        except TypeError:
-            raise endpoints.BadRequestException('Invalid Key')
-        except Exception, e:
-            if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-                raise endpoints.BadRequestException('Invalid Key')
-            else:
-                raise
+        """ Search for a game by its urlsafe key. Games that have been moved
+        to the archive are returned as read only Games. """
+        key = utils.get_by_urlsafe(urlsafe)
+        game = key.get()
+        if not game and key.kind() == cls._get_kind():
+            archive = GameArchive.archive_key(key).get()
+            game = archive and archive.to_game()
+        return game
+
+    @classmethod
+    def get_by_keys(cls, keys):
+        """ Fetch games with get_multi, falling back to the archive for any
+        games that have been archived. Missing games are skipped. """
+        return cls.fill_archived(keys, ndb.get_multi(keys))
+
+    @classmethod
+    def fill_archived(cls, keys, games):
+        """ Replaces the games missing from a get_multi of keys with their
+        archives, keeping the order of keys. Missing games are skipped. """
+        missing = [GameArchive.archive_key(key)
+                   for key, game in zip(keys, games) if not game]
+        archives = iter(missing and ndb.get_multi(missing))
+        games = [game or next(archives) for game in games]
+        return [game if isinstance(game, Game) else game.to_game()
+                for game in games if game]
 
     @classmethod
-    def by_game_state(cls, game_state, limit=10):
+    def by_game_state(cls, game_state, limit=10, keys_only=False):
         """ Search for games by their game state """
         games = (
                 cls.query()
                 .filter(cls.game_state == game_state)
                 .order(-cls.last_update)
-                .fetch(limit)
+                .fetch(limit, keys_only=keys_only)
             )
         return games
 
     @classmethod
     def get_active_games(cls, user, limit=10):
         """ Search for games that are not complete or cancelled. """
-        games = (
-            cls.query()
-            .filter(ndb.OR(
+        if MigrationStatus.is_complete('game_players'):
+            player_filter = cls.players == user.key
+        else:
+            # Older games have no players property until migrated.
+            player_filter = ndb.OR(
                 cls.player_one == user.key,
                 cls.player_two == user.key
-            ))
+            )
+        games = (
+            cls.query()
+            .filter(player_filter)
             .filter(
                 cls.game_state.IN([
                     cls.GameState.WAITING_FOR_OPPONENT,
@@ -249,6 +458,151 @@ class Game(ndb.Model):
         )
         return games
 
+    @classmethod
+    def export_pages(cls, game_state=None, since=None, until=None,
+                     cursor=None, archived=False, batch_size=100,
+                     limit=None):
+        """ Generator over pages of exported games.
+
+        Games are read with a cursor paged query, and the names of each
+        page's players are fetched with a single get_multi, so only one
+        page is held in memory at a time.
+
+        Args:
+            game_state: Only export games in this GameState.
+            since: Only export games updated at or after this datetime.
+            until: Only export games updated before this datetime.
+            cursor: ndb Cursor to resume a previous export from.
+            archived: Export the GameArchive kind instead. Archives have no
+                indexes, so they cannot be filtered.
+            batch_size: The number of games in a page.
+            limit: The most games to export. The last page is shortened to
+                stay within it.
+
+        Yields:
+            Tuples of (records, cursor, more) where records is a list of
+            dicts from to_export_dict and cursor resumes after the page.
+        """
+        if archived:
+            query = GameArchive.query()
+        else:
+            query = cls.query()
+            if game_state is not None:
+                query = query.filter(cls.game_state == game_state)
+            if since is not None:
+                query = query.filter(cls.last_update >= since)
+            if until is not None:
+                query = query.filter(cls.last_update < until)
+            query = query.order(cls.last_update)
+
+        exported = 0
+        more = True
+        while more and (limit is None or exported < limit):
+            if limit is not None:
+                batch_size = min(batch_size, limit - exported)
+            page, cursor, more = query.fetch_page(
+                batch_size, start_cursor=cursor)
+            exported += len(page)
+            if archived:
+                page = [archive.to_game() for archive in page]
+            names = cls.get_player_names(page)
+            yield [game.to_export_dict(names) for game in page], cursor, more
+
+    @classmethod
+    def from_export_dict(cls, record):
+        """ Rebuilds a Game or GameArchive from a to_export_dict record.
+
+        Players are matched by User id, so the Users must already exist.
+        The exported last_update is kept.
+        """
+        def user_key(player):
+            return player and ndb.Key(User, player['id'])
+
+        settings = cls.BoardRules()
+        for name, value in record['settings'].iteritems():
+            setattr(settings, name, value)
+        game = cls(
+                id=record['id'],
+                player_one=user_key(record['player_one']),
+                player_two=user_key(record['player_two']),
+                player_winner=user_key(record['player_winner']),
+                tournament=(record['tournament_id'] and
+                            ndb.Key(Tournament, record['tournament_id'])),
+                game_state=cls.GameState.lookup_by_name(record['game_state']),
+                game_settings=settings,
+                game_board=record['board'],
+                game_history=record['history']
+            )
+        if record['last_update']:
+            game.last_update = datetime.datetime.strptime(
+                record['last_update'], '%Y-%m-%dT%H:%M:%S.%f')
+        if record['archived']:
+            return GameArchive.from_game(game)
+        game.preserve_timestamps()
+        return game
+
+    @classmethod
+    def import_records(cls, records):
+        """ Saves a batch of to_export_dict records with put_multi.
+
+        A game lives in only one of the Game and GameArchive kinds, so
+        records for games already in the other kind are skipped.
+
+        Returns:
+            A tuple of (games imported, records skipped).
+        """
+        entities = [cls.from_export_dict(record) for record in records]
+        others = [ndb.Key(Game if isinstance(entity, GameArchive)
+                          else GameArchive, entity.key.id())
+                  for entity in entities]
+        entities = [entity for entity, other in
+                    zip(entities, ndb.get_multi(others)) if not other]
+        ndb.put_multi(entities)
+        return len(entities), len(records) - len(entities)
+
+    def to_export_dict(self, names):
+        """ Returns a JSON serializable dict of the Game.
+
+        Args:
+            names: A dict of User keys to user names.
+        """
+        def player(key):
+            return key and {'id': key.id(), 'name': names.get(key)}
+
+        return {
+            'id': self.key.id(),
+            'archived': self.archived,
+            'game_state': self.game_state.name,
+            'settings': dict((field.name, getattr(self.game_settings,
+                                                  field.name))
+                             for field in self.game_settings.all_fields()),
+            'player_one': player(self.player_one),
+            'player_two': player(self.player_two),
+            'player_winner': player(self.player_winner),
+            'tournament_id': self.tournament and self.tournament.id(),
+            'board': self.game_board,
+            'history': self.game_history,
+            'last_update': (self.last_update and
+                            self.last_update.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+        }
+
+    def _pre_put_hook(self):
+        if self.archived:
+            raise endpoints.ForbiddenException(
+                'Archived games cannot be modified.')
+        self.players = [key for key in [self.player_one, self.player_two]
+                        if key]
+        self.schema_version = Game.SCHEMA_VERSION
+        if self._preserved_last_update:
+            # auto_now has already run, so put back the original time.
+            self.last_update = self._preserved_last_update
+            self._preserved_last_update = None
+
+    def preserve_timestamps(self):
+        """ Keep last_update unchanged by the next put. Used by schema
+        migrations, which must not make old games look recently active. """
+        self._preserved_last_update = self.last_update
+
     def add_player(self, user):
         """ Add a second player to a game. """
         if not self.game_state == Game.GameState.WAITING_FOR_OPPONENT:
@@ -457,14 +811,27 @@ class Game(ndb.Model):
             if len(ship) > 0:
                 ships_remaining += 1
 
+        stats = {
+            StatShard.SHOTS: 1,
+            StatShard.HITS: hit and 1 or 0
+        }
         if ships_remaining == 0:  # 0 remaining ships, game is over.
             message.message += ' You have won!'
             self.record_win(user.key)
+            # Counters are updated outside of record_win's transaction so
+            # they do not add entity groups to it.
+            stats.update({
+                StatShard.GAMES_IN_PROGRESS: -1,
+                StatShard.GAMES_COMPLETED: 1,
+                StatShard.daily(StatShard.GAMES_COMPLETED): 1,
+                StatShard.COMPLETED_GAME_SHOTS: len(self.game_history)
+            })
         else:  # Game not over.
             message.message += ' {} ship{} remaining.'.format(
                 ships_remaining,
                 's' if ships_remaining > 1 else ''
                 )
+        StatShard.increment(stats)
 
         return message
 
@@ -509,21 +876,688 @@ class Game(ndb.Model):
         if self.game_state == Game.GameState.GAME_COMPLETE:
             raise endpoints.ForbiddenException(
                     'Cannot cancel a completed game.')
+        was_active = self.game_state != Game.GameState.GAME_CANCELLED
         self.game_state = Game.GameState.GAME_CANCELLED
         self.put()
+        if was_active:
+            StatShard.increment({
+                StatShard.GAMES_IN_PROGRESS: -1,
+                StatShard.GAMES_CANCELLED: 1
+            })
         return self
 
-    def to_form(self):
-        """Returns a GameInfoForm representation of the Game"""
+    def to_form(self, fields=None, names=None):
+        """Returns a GameInfoForm representation of the Game
+
+        Args:
+            fields: Set of GameInfoForm field names to fill in, from
+                parse_field_mask. None fills in every field.
+            names: Optional dict of User keys to user names, from
+                get_player_names. Players are fetched if not supplied.
+        """
+        fields = fields or Game.INFO_FIELDS
         form = GameInfoForm()
+        if 'urlsafe_key' in fields:
+            form.urlsafe_key = self.key.urlsafe()
+        if 'player_one' in fields:
+            form.player_one = (names.get(self.player_one) if names is not None
+                               else self.player_one.get().name)
+        if 'player_two' in fields and self.player_two:
+            form.player_two = (names.get(self.player_two) if names is not None
+                               else self.player_two.get().name)
+        if 'game_state' in fields:
+            form.game_state = self.game_state
+        if 'rules' in fields:
+            form.rules = self.game_settings
+        return form
+
+    @classmethod
+    def to_forms(cls, games, fields=None):
+        """Returns GameInfoForms for a list of Games, fetching all of their
+        players with a single get_multi if player names were requested.
+        Keys from a keys only query are accepted when fields is KEY_FIELDS.
+        """
+        if fields == cls.KEY_FIELDS:
+            return [GameInfoForm(urlsafe_key=getattr(game, 'key', game)
+                                 .urlsafe()) for game in games]
+        fields = fields or cls.INFO_FIELDS
+        names = None
+        if 'player_one' in fields or 'player_two' in fields:
+            names = cls.get_player_names(games)
+        return [game.to_form(fields, names) for game in games]
+
+    @classmethod
+    def parse_field_mask(cls, field_mask):
+        """ Converts a comma separated list of GameInfoForm field names into
+        a set. Returns None, meaning every field, if field_mask is empty.
+
+        Raises:
+            BadRequestException:
+                -If a field name is not a GameInfoForm field.
+        """
+        if not field_mask:
+            return None
+        fields = set(name.strip() for name in field_mask.split(',')
+                     if name.strip())
+        unknown = fields - cls.INFO_FIELDS
+        if unknown:
+            raise endpoints.BadRequestException(
+                'Unknown fields: {}'.format(', '.join(sorted(unknown))))
+        return fields or None
+
+    @classmethod
+    def get_player_names(cls, games):
+        """ Returns a dict of player keys to user names for a list of Games,
+        fetched with a single get_multi """
+        player_keys = set()
+        for game in games:
+            player_keys.update([game.player_one, game.player_two])
+        player_keys.discard(None)
+        player_keys = list(player_keys)
+        return dict(
+            (key, user.name) for key, user in
+            zip(player_keys, ndb.get_multi(player_keys)) if user)
+
+
+class GameArchive(ndb.Model):
+    """ Google AppEngine Datastore Entity holding a finished Game.
+
+    Completed and cancelled games are moved out of the Game kind once they
+    are old enough so the indexes used by the game queries stay small. An
+    archive shares its id with the Game it was made from and has no indexed
+    properties.
+
+    Properties:
+        player_one: ndb Key to the player that hosted the game.
+        player_two: ndb Key to the player that joined the game.
+        player_winner: ndb Key to the winner of the match.
+        tournament: ndb Key to the Tournament the game belonged to, if any.
+        game_state: GameState the game finished in.
+        game_settings: The BoardRules set for the game at creation.
+        game_data: Compressed JsonProperty holding the game's board and
+            history in the form:
+            {
+                'board': {game_board},
+                'history': [game_history]
+            }
+        last_update: A datetime of the last time the game was updated.
+        archived: A datetime of when the game was archived.
+    """
+    player_one = ndb.KeyProperty(kind='User', indexed=False)
+    player_two = ndb.KeyProperty(kind='User', indexed=False)
+    player_winner = ndb.KeyProperty(kind='User', indexed=False)
+    tournament = ndb.KeyProperty(kind='Tournament', indexed=False)
+    game_state = msgprop.EnumProperty(Game.GameState, indexed=False)
+    game_settings = msgprop.MessageProperty(Game.BoardRules)
+    game_data = ndb.JsonProperty(compressed=True)
+    last_update = ndb.DateTimeProperty(indexed=False)
+    archived = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    # Games finished longer than this ago are archived.
+    ARCHIVE_AFTER = datetime.timedelta(days=30)
+    # Number of games moved by a single put_multi/delete_multi call.
+    BATCH_SIZE = 100
+
+    @classmethod
+    def archive_key(cls, game_key):
+        """ Returns the key of the archive for a Game key """
+        return ndb.Key(cls, game_key.id())
+
+    @classmethod
+    def from_game(cls, game):
+        """ Creates an archive from a Game """
+        return cls(
+                key=cls.archive_key(game.key),
+                player_one=game.player_one,
+                player_two=game.player_two,
+                player_winner=game.player_winner,
+                tournament=game.tournament,
+                game_state=game.game_state,
+                game_settings=game.game_settings,
+                game_data={
+                    'board': game.game_board,
+                    'history': game.game_history
+                },
+                last_update=game.last_update
+            )
+
+    @classmethod
+    def archive_games(cls, older_than=None):
+        """ Moves completed and cancelled games that have not been updated
+        since older_than into the archive.
+
+        The archive is written before the game is deleted, so a run that
+        is interrupted can be run again safely.
+
+        Args:
+            older_than: datetime cutoff. Defaults to ARCHIVE_AFTER ago.
+
+        Returns:
+            The number of games archived.
+        """
+        if older_than is None:
+            older_than = datetime.datetime.now() - cls.ARCHIVE_AFTER
+        archived = 0
+        for game_state in [Game.GameState.GAME_COMPLETE,
+                           Game.GameState.GAME_CANCELLED]:
+            query = (
+                Game.query()
+                .filter(Game.game_state == game_state)
+                .filter(Game.last_update < older_than)
+            )
+            cursor = None
+            more = True
+            while more:
+                games, cursor, more = query.fetch_page(
+                    cls.BATCH_SIZE, start_cursor=cursor)
+                if not games:
+                    break
+                ndb.put_multi([cls.from_game(game) for game in games])
+                ndb.delete_multi([game.key for game in games])
+                archived += len(games)
+        return archived
+
+    def to_game(self):
+        """ Rebuilds a read only Game from the archive """
+        game = Game(
+                id=self.key.id(),
+                player_one=self.player_one,
+                player_two=self.player_two,
+                player_winner=self.player_winner,
+                tournament=self.tournament,
+                game_state=self.game_state,
+                game_settings=self.game_settings,
+                game_board=self.game_data['board'],
+                game_history=self.game_data['history'],
+                last_update=self.last_update
+            )
+        game.archived = True
+        return game
+
+
+class Tournament(ndb.Model):
+    """ Google AppEngine Datastore Entity representing a set of games
+    created together for an event.
+
+    The games of a tournament are given a contiguous block of ids when the
+    tournament is created, so they can be fetched and updated with batched
+    get_multi/put_multi calls instead of a query.
+
+    Properties:
+        name: A string property naming the tournament.
+        tournament_format: TournamentFormat used to pair the players.
+        game_settings: The BoardRules used for every game of the tournament.
+        players: ndb Keys to the participating Users.
+        first_game_id: The id of the first Game of the tournament.
+        games_total: The number of games the tournament will contain.
+        games_created: The number of games saved so far.
+        games_cancelled: The number of games cancelled in bulk.
+        created: A datetime of when the tournament was created.
+    """
+    class TournamentFormat(messages.Enum):
+        """ Enum for representing how players are paired. """
+        # Every player plays every other player once.
+        ROUND_ROBIN = 0
+        # Players are paired in the order given. Odd player out gets a bye.
+        BRACKET = 1
+
+    name = ndb.StringProperty(required=True)
+    tournament_format = msgprop.EnumProperty(TournamentFormat, required=True)
+    game_settings = msgprop.MessageProperty(Game.BoardRules, required=True)
+    players = ndb.KeyProperty(kind='User', repeated=True, indexed=False)
+    first_game_id = ndb.IntegerProperty(indexed=False)
+    games_total = ndb.IntegerProperty(required=True, default=0,
+                                      indexed=False)
+    games_created = ndb.IntegerProperty(required=True, default=0,
+                                        indexed=False)
+    games_cancelled = ndb.IntegerProperty(required=True, default=0,
+                                          indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    # Number of games written by a single put_multi/get_multi call.
+    BATCH_SIZE = 100
+    # Number of batches sent to the datastore at the same time.
+    PARALLEL_BATCHES = 10
+    # Most games a tournament can have, so it is created in one request.
+    MAX_GAMES = 2000
+    # Most games returned by a page of get_games.
+    MAX_PAGE_SIZE = 500
+    # Games cancelled per transaction. Cross-group transactions allow 25.
+    CANCEL_CHUNK_SIZE = 25
+
+    @classmethod
+    def create_tournament(cls, form):
+        """ Creates a new Tournament and all of its games.
+
+        Args:
+            form: TournamentForm containing the players and rules.
+
+        Returns:
+            Returns the newly created Tournament.
+
+        Raises:
+            BadRequestException:
+                -If the rules are invalid or too few players are given.
+                -If a player is listed more than once.
+                -If the tournament would have more than MAX_GAMES games.
+            NotFoundException:
+                -If a player has not registered.
+        """
+        settings = Game.check_rules(form.get_assigned_value('rules'))
+        if len(form.players) < 2:
+            raise endpoints.BadRequestException(
+                'A tournament needs at least two players.')
+        if len(set(form.players)) != len(form.players):
+            raise endpoints.BadRequestException(
+                'A player can only be entered once.')
+
+        players = len(form.players)
+        if form.tournament_format == cls.TournamentFormat.BRACKET:
+            games_total = players // 2
+        else:
+            games_total = players * (players - 1) // 2
+        if games_total > cls.MAX_GAMES:
+            raise endpoints.BadRequestException(
+                'A tournament can have at most {} games.'.format(
+                    cls.MAX_GAMES))
+
+        # Look up all of the players at once.
+        futures = [User.query(User.name == name).get_async()
+                   for name in form.players]
+        players = []
+        for name, future in zip(form.players, futures):
+            user = future.get_result()
+            if not user:
+                raise endpoints.NotFoundException(
+                    'User {} does not exist.'.format(name))
+            players.append(user.key)
+
+        pairings = cls.get_pairings(form.tournament_format, players)
+        first_id, _ = Game.allocate_ids(size=len(pairings))
+        tournament = Tournament(
+                name=form.name,
+                tournament_format=form.tournament_format,
+                game_settings=settings,
+                players=players,
+                first_game_id=first_id,
+                games_total=len(pairings)
+            )
+        tournament.put()
+
+        games = []
+        for i, (p1, p2) in enumerate(pairings):
+            games.append(Game(
+                    id=first_id + i,
+                    player_one=p1,
+                    player_two=p2,
+                    tournament=tournament.key,
+                    game_state=Game.GameState.PREPARING_BOARD,
+                    game_settings=settings,
+                    game_board={},
+                    game_history=[]
+                ))
+
+        # Save the games in waves of parallel batches, recording progress
+        # after each wave so a large tournament can be monitored.
+        wave_size = cls.BATCH_SIZE * cls.PARALLEL_BATCHES
+        for wave in utils.chunks(games, wave_size):
+            futures = [ndb.put_multi_async(batch) for batch in
+                       utils.chunks(wave, cls.BATCH_SIZE)]
+            ndb.Future.wait_all(futures)
+            for future in futures:
+                future.check_success()
+            tournament.games_created += len(wave)
+            tournament.put()
+            StatShard.increment({
+                StatShard.GAMES_CREATED: len(wave),
+                StatShard.GAMES_IN_PROGRESS: len(wave)
+            })
+        return tournament
+
+    @classmethod
+    def get_pairings(cls, tournament_format, players):
+        """ Returns a list of (player_one, player_two) pairs of players """
+        if tournament_format == cls.TournamentFormat.BRACKET:
+            return [(players[i], players[i + 1])
+                    for i in xrange(0, len(players) - 1, 2)]
+        return [(players[i], players[j])
+                for i in xrange(len(players))
+                for j in xrange(i + 1, len(players))]
+
+    @classmethod
+    def by_urlsafe(cls, urlsafe):
+        """ Search for a tournament by its urlsafe key """
+        key = utils.get_by_urlsafe(urlsafe)
+        tournament = key.kind() == cls._get_kind() and key.get()
+        if not tournament:
+            raise endpoints.NotFoundException('Tournament not found.')
+        return tournament
+
+    def game_keys(self, offset=0, limit=None):
+        """ Returns the keys of the tournament's games """
+        if offset < 0:
+            raise endpoints.BadRequestException('Offset cannot be negative.')
+        if limit is not None and limit < 1:
+            raise endpoints.BadRequestException('Limit must be positive.')
+        end = self.games_created
+        if limit is not None:
+            end = min(end, offset + limit)
+        return [ndb.Key(Game, self.first_game_id + i)
+                for i in xrange(offset, end)]
+
+    def get_games(self, offset=0, limit=None):
+        """ Fetches a page of the tournament's games with parallel
+        get_multi calls. At most MAX_PAGE_SIZE games are returned. """
+        if limit is None or limit > self.MAX_PAGE_SIZE:
+            limit = self.MAX_PAGE_SIZE
+        keys = self.game_keys(offset, limit)
+        futures = []
+        for batch in utils.chunks(keys, self.BATCH_SIZE):
+            futures.extend(ndb.get_multi_async(batch))
+        games = [future.get_result() for future in futures]
+        # Finished games may have been moved to the archive.
+        return Game.fill_archived(keys, games)
+
+    def cancel_games(self):
+        """ Cancels every game of the tournament that is not finished.
+
+        Games are re-read and cancelled in small cross-group transactions,
+        so a game that finishes while the tournament is being cancelled
+        keeps its result.
+        """
+        cancelled = 0
+        chunks = utils.chunks(self.game_keys(), self.CANCEL_CHUNK_SIZE)
+        for wave in utils.chunks(chunks, self.PARALLEL_BATCHES):
+            futures = [self._cancel_chunk(keys) for keys in wave]
+            cancelled += sum(future.get_result() for future in futures)
+        self.games_cancelled += cancelled
+        self.put()
+        StatShard.increment({
+            StatShard.GAMES_IN_PROGRESS: -cancelled,
+            StatShard.GAMES_CANCELLED: cancelled
+        })
+        return self
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _cancel_chunk(keys):
+        """ Transaction cancelling the unfinished games among keys. Returns
+        the number of games cancelled. Archived games are finished, so
+        games missing from the Game kind are skipped. """
+        games = yield ndb.get_multi_async(keys)
+        cancelled = [game for game in games if game and game.game_state not in
+                     [Game.GameState.GAME_COMPLETE,
+                      Game.GameState.GAME_CANCELLED]]
+        for game in cancelled:
+            game.game_state = Game.GameState.GAME_CANCELLED
+        if cancelled:
+            yield ndb.put_multi_async(cancelled)
+        raise ndb.Return(len(cancelled))
+
+    def to_form(self):
+        """Returns a TournamentInfoForm representation of the Tournament"""
+        form = TournamentInfoForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.player_one = self.player_one.get().name
-        form.player_two = self.player_two and self.player_two.get().name
-        form.game_state = self.game_state
+        form.name = self.name
+        form.tournament_format = self.tournament_format
         form.rules = self.game_settings
+        form.games_total = self.games_total
+        form.games_created = self.games_created
+        form.games_cancelled = self.games_cancelled
         return form
 
 
+class StatShard(ndb.Model):
+    """ Google AppEngine Datastore Entity holding one shard of a global
+    statistics counter.
+
+    Each counter is split over NUM_SHARDS entities, each in its own entity
+    group, so updates from many requests do not contend with each other.
+    The id of a shard is in the form '{counter name}-{shard index}'.
+
+    Properties:
+        count: An integer property holding this shard's part of the total.
+    """
+    count = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+    NUM_SHARDS = 20
+    # Seconds that counter totals are kept in memcache.
+    CACHE_TIME = 60
+    CACHE_PREFIX = 'stat:'
+    # Number of games read by each page of a recount.
+    BATCH_SIZE = 500
+
+    # Counter names.
+    GAMES_CREATED = 'games_created'
+    GAMES_IN_PROGRESS = 'games_in_progress'
+    GAMES_COMPLETED = 'games_completed'
+    GAMES_CANCELLED = 'games_cancelled'
+    SHOTS = 'shots'
+    HITS = 'hits'
+    # Total guesses made in completed games, for the average game length.
+    COMPLETED_GAME_SHOTS = 'completed_game_shots'
+
+    @classmethod
+    def daily(cls, name, day=None):
+        """ Returns the name of the per day counter for a counter """
+        day = day or datetime.date.today()
+        return '{}:{}'.format(name, day.isoformat())
+
+    @classmethod
+    def increment(cls, deltas):
+        """ Add to several counters at once.
+
+        A single random shard index is used for all of the counters so the
+        whole update is one small transaction. The transaction is
+        independent of any transaction the caller is in. Statistics are
+        best effort, so a failed update is logged rather than raised.
+
+        Args:
+            deltas: A dict of counter names to the amount to add.
+        """
+        deltas = dict((name, delta) for name, delta in deltas.iteritems()
+                      if delta)
+        if not deltas:
+            return
+        try:
+            cls._increment_shards(deltas,
+                                  random.randint(0, cls.NUM_SHARDS - 1))
+        except datastore_errors.Error:
+            logging.warning('Failed to update stats %s', deltas,
+                            exc_info=True)
+            return
+        # Only updates totals that are already cached. Memcache cannot go
+        # below zero, so totals being lowered are dropped and recounted.
+        memcache.offset_multi(
+            dict((name, delta) for name, delta in deltas.iteritems()
+                 if delta > 0),
+            key_prefix=cls.CACHE_PREFIX)
+        memcache.delete_multi(
+            [name for name, delta in deltas.iteritems() if delta < 0],
+            key_prefix=cls.CACHE_PREFIX)
+
+    @classmethod
+    @ndb.transactional(
+        xg=True, propagation=ndb.TransactionOptions.INDEPENDENT)
+    def _increment_shards(cls, deltas, index):
+        names = deltas.keys()
+        keys = [ndb.Key(cls, '{}-{}'.format(name, index)) for name in names]
+        shards = ndb.get_multi(keys)
+        for i, name in enumerate(names):
+            shards[i] = shards[i] or cls(key=keys[i])
+            shards[i].count += deltas[name]
+        ndb.put_multi(shards)
+
+    @classmethod
+    def get_totals(cls, names):
+        """ Returns a dict of counter names to their summed shards """
+        totals = memcache.get_multi(names, key_prefix=cls.CACHE_PREFIX)
+        missing = [name for name in names if name not in totals]
+        if missing:
+            keys = [ndb.Key(cls, '{}-{}'.format(name, index))
+                    for name in missing
+                    for index in xrange(cls.NUM_SHARDS)]
+            shards = ndb.get_multi(keys)
+            counted = {}
+            for i, name in enumerate(missing):
+                counted[name] = sum(
+                    shard.count for shard in
+                    shards[i * cls.NUM_SHARDS:(i + 1) * cls.NUM_SHARDS]
+                    if shard)
+            memcache.add_multi(counted, time=cls.CACHE_TIME,
+                               key_prefix=cls.CACHE_PREFIX)
+            totals.update(counted)
+        return totals
+
+    @classmethod
+    def seed(cls, shards=8):
+        """ Sets the counters from the games in the datastore.
+
+        The counters only track changes made after they were deployed.
+        Run this once after deploying them, so that games already in
+        progress do not make games_in_progress negative when they finish.
+        Running it again recounts the counters. Games changed while it runs
+        may be counted twice or missed.
+
+        Returns:
+            A dict of counter names to their seeded totals.
+        """
+        futures = []
+        for lo, hi in utils.split_key_ranges(Game, shards):
+            futures.append(cls._count_games(
+                utils.filter_key_range(Game.query(), Game, lo, hi)))
+        for lo, hi in utils.split_key_ranges(GameArchive, shards):
+            futures.append(cls._count_games(
+                utils.filter_key_range(GameArchive.query(), GameArchive,
+                                       lo, hi)))
+        counted = {}
+        for future in futures:
+            for name, count in future.get_result().iteritems():
+                counted[name] = counted.get(name, 0) + count
+
+        names = [cls.GAMES_CREATED, cls.GAMES_IN_PROGRESS,
+                 cls.GAMES_COMPLETED, cls.GAMES_CANCELLED, cls.SHOTS,
+                 cls.HITS, cls.COMPLETED_GAME_SHOTS,
+                 cls.daily(cls.GAMES_COMPLETED)]
+        memcache.delete_multi(names, key_prefix=cls.CACHE_PREFIX)
+        totals = cls.get_totals(names)
+        cls.increment(dict((name, counted.get(name, 0) - totals[name])
+                           for name in names))
+        memcache.delete_multi(names, key_prefix=cls.CACHE_PREFIX)
+        return dict((name, counted.get(name, 0)) for name in names)
+
+    @classmethod
+    @ndb.tasklet
+    def _count_games(cls, query):
+        """ Tasklet counting the statistics of a query of Games or
+        GameArchives. Returns a dict of counter names to counts. """
+        today = datetime.date.today()
+        counts = {}
+
+        def add(name, count=1):
+            counts[name] = counts.get(name, 0) + count
+
+        cursor = None
+        more = True
+        while more:
+            games, cursor, more = yield query.fetch_page_async(
+                cls.BATCH_SIZE, start_cursor=cursor)
+            if games and isinstance(games[0], GameArchive):
+                # Skip archives whose Game was not deleted. The Game is
+                # counted instead.
+                live = yield ndb.get_multi_async(
+                    [ndb.Key(Game, game.key.id()) for game in games])
+                games = [game.to_game() for game, game_live
+                         in zip(games, live) if not game_live]
+            for game in games:
+                add(cls.GAMES_CREATED)
+                shots = len(game.game_history)
+                add(cls.SHOTS, shots)
+                add(cls.HITS, len([guess for guess in game.game_history
+                                   if guess[2] != 'Miss.']))
+                if game.game_state == Game.GameState.GAME_COMPLETE:
+                    add(cls.GAMES_COMPLETED)
+                    add(cls.COMPLETED_GAME_SHOTS, shots)
+                    if game.last_update.date() == today:
+                        add(cls.daily(cls.GAMES_COMPLETED))
+                elif game.game_state == Game.GameState.GAME_CANCELLED:
+                    add(cls.GAMES_CANCELLED)
+                else:
+                    add(cls.GAMES_IN_PROGRESS)
+        raise ndb.Return(counts)
+
+    @classmethod
+    def get_stats(cls):
+        """ Returns a StatsForm of the global game statistics """
+        today = cls.daily(cls.GAMES_COMPLETED)
+        totals = cls.get_totals([
+            cls.GAMES_CREATED, cls.GAMES_IN_PROGRESS, cls.GAMES_COMPLETED,
+            cls.GAMES_CANCELLED, cls.SHOTS, cls.HITS,
+            cls.COMPLETED_GAME_SHOTS, today])
+        completed = totals[cls.GAMES_COMPLETED]
+        return StatsForm(
+                games_created=totals[cls.GAMES_CREATED],
+                games_in_progress=totals[cls.GAMES_IN_PROGRESS],
+                games_completed=completed,
+                games_completed_today=totals[today],
+                games_cancelled=totals[cls.GAMES_CANCELLED],
+                total_shots=totals[cls.SHOTS],
+                hit_rate=(1. * totals[cls.SHOTS] and
+                          1. * totals[cls.HITS] / totals[cls.SHOTS]),
+                average_game_length=(
+                    1. * completed and
+                    1. * totals[cls.COMPLETED_GAME_SHOTS] / completed)
+            )
+
+
+class MigrationStatus(ndb.Model):
+    """ Google AppEngine Datastore Entity tracking the progress of a schema
+    migration. The id of the entity is the name of the migration.
+
+    Properties:
+        run: Incremented each time the migration is started.
+        cursor: urlsafe cursor to the next batch of keys to migrate.
+        processed: The number of entities checked in this run.
+        migrated: The number of entities changed in this run.
+        done: True once every entity has been checked.
+        error: Why the migration stopped, if it failed.
+        last_update: A datetime of the last batch.
+    """
+    run = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    processed = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    migrated = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    done = ndb.BooleanProperty(required=True, default=False, indexed=False)
+    error = ndb.StringProperty(indexed=False)
+    last_update = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    CACHE_PREFIX = 'migration_done:'
+    # Seconds an unfinished migration is cached as unfinished.
+    CACHE_TIME = 60
+
+    @classmethod
+    def is_complete(cls, name):
+        """ Check whether a migration has finished. Cached in memcache. """
+        done = memcache.get(cls.CACHE_PREFIX + name)
+        if done is None:
+            status = cls.get_by_id(name)
+            done = bool(status and status.done)
+            memcache.set(cls.CACHE_PREFIX + name, done,
+                         time=0 if done else cls.CACHE_TIME)
+        return done
+
+    def to_dict(self):
+        """ Returns a JSON serializable dict of the status """
+        return {
+            'name': self.key.id(),
+            'run': self.run,
+            'processed': self.processed,
+            'migrated': self.migrated,
+            'done': self.done,
+            'error': self.error
+        }
+
+
 class RegisterUserForm(messages.Message):
     """ Form used when registering a user's name """
     user_name = messages.StringField(1, required=True)
@@ -549,6 +1583,26 @@ class GameListForm(messages.Message):
     games = messages.MessageField(GameInfoForm, 1, repeated=True)
 
 
+class TournamentForm(messages.Message):
+    """ Form used when creating a new tournament """
+    name = messages.StringField(1, required=True)
+    players = messages.StringField(2, repeated=True)
+    rules = messages.MessageField(Game.BoardRules, 3)
+    tournament_format = messages.EnumField(Tournament.TournamentFormat, 4,
+                                           default='ROUND_ROBIN')
+
+
+class TournamentInfoForm(messages.Message):
+    """ Form used when returning a tournament's info """
+    urlsafe_key = messages.StringField(1)
+    name = messages.StringField(2)
+    tournament_format = messages.EnumField(Tournament.TournamentFormat, 3)
+    rules = messages.MessageField(Game.BoardRules, 4)
+    games_total = messages.IntegerField(5)
+    games_created = messages.IntegerField(6)
+    games_cancelled = messages.IntegerField(7)
+
+
 class Position(messages.Message):
     """ Message representing coordinates """
     x = messages.IntegerField(1, required=True)
@@ -598,6 +1652,32 @@ class RankingForm(messages.Message):
     rankings = messages.MessageField(Ranking, 1, repeated=True)
 
 
+class ThrottleCount(messages.Message):
+    """ Message representing the calls to a method rejected by the
+    rate limiter """
+    method = messages.StringField(1, required=True)
+    count = messages.IntegerField(2, required=True)
+
+
+class StatsForm(messages.Message):
+    """ Form used to report global game statistics
+
+    Properties:
+        hit_rate: Fraction of all guesses that hit a ship.
+        average_game_length: Average number of guesses in a completed game.
+        throttled: Calls rejected by the rate limiter on this app.
+    """
+    games_created = messages.IntegerField(1, required=True)
+    games_in_progress = messages.IntegerField(2, required=True)
+    games_completed = messages.IntegerField(3, required=True)
+    games_completed_today = messages.IntegerField(4, required=True)
+    games_cancelled = messages.IntegerField(5, required=True)
+    total_shots = messages.IntegerField(6, required=True)
+    hit_rate = messages.FloatField(7, required=True)
+    average_game_length = messages.FloatField(8, required=True)
+    throttled = messages.MessageField(ThrottleCount, 9, repeated=True)
+
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     message = messages.StringField(1, required=True)
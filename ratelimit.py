@@ -0,0 +1,86 @@
+"""ratelimit.py - Per user token bucket rate limiting of endpoints methods.
+
+Each user has a bucket per endpoint stored in memcache. A call takes one
+token from the bucket, and tokens refill at a steady rate up to the
+bucket's capacity. Calls made with an empty bucket are rejected before the
+method runs, so they cost no datastore access."""
+
+import functools
+import time
+
+import endpoints
+from google.appengine.api import memcache
+
+import utils
+
+BUCKET_PREFIX = 'ratelimit:'
+THROTTLED_PREFIX = 'ratelimit_throttled:'
+# Attempts to update a bucket before giving up and allowing the call.
+CAS_RETRIES = 3
+
+# Names of the methods that are rate limited.
+limited_methods = []
+
+
+class TooManyRequestsException(endpoints.ForbiddenException):
+    """ Raised when a user has used up their budget for a method.
+
+    Endpoints only passes a few 4xx statuses through to the client and
+    turns the rest, including 429, into 404. A 403 with its own message
+    is used instead.
+    """
+
+
+def limit(capacity, per_second):
+    """ Decorator limiting how often each user can call an endpoints method.
+    Place it below the @endpoints.method declaration.
+
+    Args:
+        capacity: The most calls a user can make in a burst.
+        per_second: The rate at which calls are allowed once the burst has
+            been used.
+    """
+    def decorator(method):
+        name = method.__name__
+        limited_methods.append(name)
+
+        @functools.wraps(method)
+        def wrapper(self, request):
+            auth_user = utils.get_auth_user()
+            key = '{}{}:{}'.format(BUCKET_PREFIX, name, auth_user.email())
+            if not _take_token(key, capacity, per_second):
+                memcache.incr(THROTTLED_PREFIX + name, initial_value=0)
+                raise TooManyRequestsException(
+                    'Rate limit exceeded. Try again later.')
+            return method(self, request)
+        return wrapper
+    return decorator
+
+
+def _take_token(key, capacity, per_second):
+    """ Takes a token from a bucket. Returns False if it is empty """
+    client = memcache.Client()
+    # A bucket left alone this long is full, so it can be dropped.
+    expiry = int(capacity / per_second) + 1
+    for _ in xrange(CAS_RETRIES):
+        now = time.time()
+        bucket = client.gets(key)
+        if bucket is None:
+            if client.add(key, (capacity - 1, now), time=expiry):
+                return True
+            continue
+        tokens, updated = bucket
+        tokens = min(capacity, tokens + (now - updated) * per_second)
+        if tokens < 1:
+            return False
+        if client.cas(key, (tokens - 1, now), time=expiry):
+            return True
+    # Memcache is too busy to keep count. Don't punish the user for it.
+    return True
+
+
+def get_throttled_counts():
+    """ Returns a dict of method names to their number of rejected calls.
+    Counts are kept in memcache, so they reset if evicted. """
+    counts = memcache.get_multi(limited_methods, key_prefix=THROTTLED_PREFIX)
+    return dict((name, counts.get(name, 0)) for name in limited_methods)
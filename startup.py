@@ -0,0 +1,62 @@
+"""startup.py - Measures the cost of starting an instance: how long each
+module takes to import and how long the first request to each WSGI app
+takes. Results are kept per instance and reported by /admin/startup.
+
+Module import times are only recorded by a warmup request. An instance
+started by a user request loads its modules before any handler runs, so it
+only reports its first request latency."""
+
+import importlib
+import logging
+import time
+
+# Close to the time the instance started, as every entry point module
+# (battleships.py, main.py, warmup.py) imports this first.
+INSTANCE_START = time.time()
+
+# Module name to seconds taken by its first import.
+import_times = {}
+# WSGI app name to a dict of the first request's timings.
+first_requests = {}
+
+
+def timed_import(name):
+    """ Imports a module, recording how long it took if it was not
+    already imported """
+    start = time.time()
+    module = importlib.import_module(name)
+    elapsed = time.time() - start
+    import_times.setdefault(name, elapsed)
+    logging.info('Imported %s in %.1fms', name, elapsed * 1000)
+    return module
+
+
+def measure_first_request(name, app):
+    """ Wraps a WSGI app to record the latency of its first request.
+    Warmup requests are not counted. """
+    def wrapped_app(environ, start_response):
+        if (name in first_requests or
+                environ.get('PATH_INFO') == '/_ah/warmup'):
+            return app(environ, start_response)
+        start = time.time()
+        try:
+            return app(environ, start_response)
+        finally:
+            end = time.time()
+            first_requests.setdefault(name, {
+                'path': environ.get('PATH_INFO'),
+                'duration': end - start,
+                'since_instance_start': end - INSTANCE_START
+            })
+            logging.info('First request to %s took %.1fms', name,
+                         (end - start) * 1000)
+    return wrapped_app
+
+
+def report():
+    """ Returns a dict of the startup timings of this instance """
+    return {
+        'instance_start': INSTANCE_START,
+        'import_times': import_times,
+        'first_requests': first_requests
+    }
@@ -1,5 +1,7 @@
 """utils.py - File for collecting general utility functions."""
 import endpoints
+from google.appengine.api import oauth
+from google.appengine.ext import ndb
 
 
 def get_auth_user():
@@ -8,3 +10,64 @@ def get_auth_user():
     if not auth_user:
         raise endpoints.UnauthorizedException('Unauthorized.')
     return auth_user
+
+
+def get_admin_user():
+    """ Checks the authenticated user is an administrator of the app """
+    auth_user = get_auth_user()
+    if not oauth.is_current_user_admin(endpoints.EMAIL_SCOPE):
+        raise endpoints.ForbiddenException('Administrator access required.')
+    return auth_user
+
+
+def get_by_urlsafe(urlsafe):
+    """ Converts a urlsafe string into an ndb Key """
+    try:
+        return ndb.Key(urlsafe=urlsafe)
+    except TypeError:
+        raise endpoints.BadRequestException('Invalid Key')
+    except Exception, e:
+        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            raise endpoints.BadRequestException('Invalid Key')
+        else:
+            raise
+
+
+def chunks(items, size):
+    """ Splits a list into consecutive lists of at most size items """
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
+def split_key_ranges(model, shards):
+    """ Splits the keys of a kind into roughly equal ranges.
+
+    Split points are sampled from the __scatter__ property the datastore
+    keeps on a random subset of entities.
+
+    Returns:
+        A list of (lo, hi) key pairs. lo is inclusive, hi is exclusive and
+        None means the range is unbounded on that side.
+    """
+    keys = (model.query()
+            .order(ndb.GenericProperty('__scatter__'))
+            .fetch(shards * 32, keys_only=True))
+    if not keys:
+        # Empty and small kinds have no __scatter__ sample.
+        return [(None, None)]
+    keys.sort()
+    # n sampled keys can split the kind into at most n + 1 ranges.
+    shards = min(shards, len(keys) + 1)
+    splits = [keys[len(keys) * i // shards] for i in xrange(1, shards)]
+    # Drop duplicate split points when there are few entities.
+    splits = sorted(set(splits))
+    bounds = [None] + splits + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def filter_key_range(query, model, lo, hi):
+    """ Restricts a query to keys in the range [lo, hi) """
+    if lo is not None:
+        query = query.filter(model.key >= lo)
+    if hi is not None:
+        query = query.filter(model.key < hi)
+    return query
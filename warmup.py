@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""warmup.py - Handlers for warming up new instances. This module only
+imports what it needs to start, so the cost of the rest of the app can be
+measured as it is loaded."""
+
+import json
+import webapp2
+
+import startup
+
+# Modules loaded by a warmup request, in order. Each is timed separately,
+# so each time excludes the modules loaded before it.
+WARMUP_MODULES = [
+    'endpoints',
+    'protorpc.remote',
+    'google.appengine.ext.ndb',
+    'models',
+    'battleships',
+    'main'
+]
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Preload the app's modules and prime caches before the instance
+        receives traffic. Called by App Engine when starting an instance."""
+        modules = dict((name, startup.timed_import(name))
+                       for name in WARMUP_MODULES)
+        # Fill the memcache totals read by get_stats.
+        modules['models'].StatShard.get_stats()
+
+
+class StartupReport(webapp2.RequestHandler):
+    def get(self):
+        """Report the startup timings of the instance serving the request."""
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(startup.report()))
+
+
+app = startup.measure_first_request('warmup.app', webapp2.WSGIApplication([
+    ('/_ah/warmup', Warmup),
+    ('/admin/startup', StartupReport)
+    ], debug=True))